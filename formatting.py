@@ -0,0 +1,51 @@
+"""
+Format dispatch calls as ntfy notification text.
+"""
+
+import re
+
+# Socrata's fixed "2026-02-04T16:58:12.000" layout; validated up front so
+# malformed values fall through without raising
+TIMESTAMP_RE = re.compile(r"(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2})")
+
+
+def format_call(call):
+    # Format datetime as "2/5/2026 8:51 PM"
+    received = call.get("received_datetime", "")
+    match = TIMESTAMP_RE.match(received) if received else None
+    if match:
+        year, month, day, hour, minute = map(int, match.groups())
+        ampm = "AM" if hour < 12 else "PM"
+        received_formatted = f"{month}/{day}/{year} {hour % 12 or 12}:{minute:02d} {ampm}"
+    elif received:
+        received_formatted = received
+    else:
+        received_formatted = "Unknown time"
+
+    call_type = call.get("call_type_original_desc") or "Unknown"
+    intersection = call.get("intersection_name") or "Unknown location"
+    neighborhood = call.get("analysis_neighborhood") or ""
+    agency = call.get("agency") or "Unknown agency"
+    sensitive = call.get("sensitive_call", False)
+    onview_flag = call.get("onview_flag", "Unknown")
+
+    if sensitive:
+        intersection = "[Sensitive - location suppressed]"
+
+    # Determine source
+    if onview_flag == "HSOC":
+        source = "HSOC Program"
+    else:
+        source = f"Call Type Filter ({onview_flag})"
+
+    lines = [
+        f"Time: {received_formatted}",
+        f"Type: {call_type}",
+        f"Location: {intersection}",
+    ]
+    if neighborhood and not sensitive:
+        lines.append(f"Neighborhood: {neighborhood}")
+    lines.append(f"Agency: {agency}")
+    lines.append(f"Source: {source}")
+
+    return "\n".join(lines)
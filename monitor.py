@@ -4,95 +4,109 @@ Monitor SF Law Enforcement Dispatched Calls for Service (Real-Time)
 and send push notifications via ntfy.sh when new calls appear.
 """
 
-import json
+import orjson
 import os
+import random
 import requests
 import time
+from requests.adapters import HTTPAdapter
 from pathlib import Path
+from types import MappingProxyType
 from datetime import datetime, timezone
 
+from formatting import format_call
+
 # --- Configuration ---
 NTFY_TOPIC = os.environ.get("NTFY_TOPIC", "sf-dispatch-alerts-3190")
 NTFY_URL = f"https://ntfy.sh/{NTFY_TOPIC}"
 CHECK_INTERVAL_SECONDS = int(os.environ.get("CHECK_INTERVAL", "300"))
 STATE_DIR = Path(os.environ.get("STATE_DIR", str(Path(__file__).parent)))
 STATE_FILE = STATE_DIR / ".last_state.json"
+SEEN_IDS_MAX = 5000  # Seen call IDs kept in the state file, oldest dropped first
+NOTIFICATION_BATCH_SIZE = 10  # Calls combined into a single notification
 
 DATASET_ID = "gnap-fj3t"
 BASE_URL = f"https://data.sfgov.org/resource/{DATASET_ID}.json"
-METADATA_URL = f"https://data.sfgov.org/api/views/{DATASET_ID}.json"
+
+# SODA query for the most recent matching calls; fixed, so built once
+CALLS_QUERY = MappingProxyType({
+    # Only the columns used for dedup and format_call
+    "$select": "id,cad_number,received_datetime,call_type_original_desc,intersection_name,analysis_neighborhood,agency,sensitive_call,onview_flag",
+    # id breaks ties between calls received in the same second, so the set of
+    # rows at the $limit boundary is stable between fetches
+    "$order": "received_datetime DESC, id DESC",
+    "$limit": 200,
+    "$where": "onview_flag = 'HSOC' OR call_type_original_desc IN ('SIT/LIE ENFORCEMENT', 'HOMELESS COMPLAINT', 'MEET W/CITY EMPLOYEE')",
+})
+
+# Shared session so repeated requests to each host reuse one connection
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
 
 
 def load_state():
+    # seen_ids is a dict used as an insertion-ordered set (oldest first), so
+    # lookups stay O(1) and save_state can drop the oldest IDs
     if STATE_FILE.exists():
-        return json.loads(STATE_FILE.read_text())
-    return {"seen_ids": [], "rows_updated_at": None}
+        data = orjson.loads(STATE_FILE.read_bytes())
+        return {
+            "seen_ids": dict.fromkeys(data.get("seen_ids", [])),
+            "calls_etag": data.get("calls_etag"),
+        }
+    return {"seen_ids": {}, "calls_etag": None}
 
 
 def save_state(state):
-    STATE_FILE.write_text(json.dumps(state))
-
-
-def get_rows_updated_at():
-    resp = requests.get(METADATA_URL, timeout=30)
-    resp.raise_for_status()
-    return resp.json().get("rowsUpdatedAt")
-
-
-def fetch_recent_calls(limit=200):
-    params = {
-        "$order": "received_datetime DESC",
-        "$limit": limit,
-        "$where": "onview_flag = 'HSOC' OR call_type_original_desc IN ('SIT/LIE ENFORCEMENT', 'HOMELESS COMPLAINT', 'MEET W/CITY EMPLOYEE')",
-    }
-    resp = requests.get(BASE_URL, params=params, timeout=30)
+    # Write to a temp file, fsync it, then rename over the old one, so a crash
+    # can't leave a truncated or empty state file behind
+    tmp = STATE_FILE.with_suffix(".json.tmp")
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps({
+            "seen_ids": list(state["seen_ids"])[-SEEN_IDS_MAX:],
+            "calls_etag": state["calls_etag"],
+        }))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, STATE_FILE)
+
+
+def fetch_recent_calls(etag=None):
+    """Return (calls, ETag); calls is None if unchanged since `etag`."""
+    headers = {"If-None-Match": etag} if etag else {}
+    resp = SESSION.get(BASE_URL, params=CALLS_QUERY, headers=headers, timeout=30)
+    if resp.status_code == 304:
+        return None, etag
     resp.raise_for_status()
-    return resp.json()
-
+    return orjson.loads(resp.content), resp.headers.get("ETag")
 
-def format_call(call):
-    # Format datetime as "2/5/2026 8:51 PM"
-    received = call.get("received_datetime", "")
-    if received:
-        try:
-            dt = datetime.fromisoformat(received.replace("Z", "+00:00"))
-            received_formatted = dt.strftime("%-m/%-d/%Y %-I:%M %p")
-        except:
-            received_formatted = received
-    else:
-        received_formatted = "Unknown time"
 
-    call_type = call.get("call_type_original_desc") or "Unknown"
-    intersection = call.get("intersection_name") or "Unknown location"
-    neighborhood = call.get("analysis_neighborhood") or ""
-    agency = call.get("agency") or "Unknown agency"
-    sensitive = call.get("sensitive_call", False)
-    onview_flag = call.get("onview_flag", "Unknown")
+class TokenBucket:
+    """Client-side rate limiter: sleeps until a request fits the quota."""
 
-    if sensitive:
-        intersection = "[Sensitive - location suppressed]"
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
 
-    # Determine source
-    if onview_flag == "HSOC":
-        source = "HSOC Program"
-    else:
-        source = f"Call Type Filter ({onview_flag})"
+    def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            time.sleep((1 - self.tokens) / self.rate)
 
-    lines = [
-        f"Time: {received_formatted}",
-        f"Type: {call_type}",
-        f"Location: {intersection}",
-    ]
-    if neighborhood and not sensitive:
-        lines.append(f"Neighborhood: {neighborhood}")
-    lines.append(f"Agency: {agency}")
-    lines.append(f"Source: {source}")
 
-    return "\n".join(lines)
+# ntfy.sh's default per-visitor request limit: bursts of 60, one more every 5s
+NTFY_BUCKET = TokenBucket(rate=1 / 5, burst=60)
 
 
 def send_notification(title, message):
-    resp = requests.post(
+    NTFY_BUCKET.acquire()
+    resp = SESSION.post(
         NTFY_URL,
         data=message.encode("utf-8"),
         headers={
@@ -107,7 +121,7 @@ def send_notification(title, message):
 
 
 def send_notification_with_backoff(title, message, max_retries=5):
-    """Send notification with exponential backoff on rate limit errors."""
+    """Send notification with backoff on rate limit errors, honoring Retry-After."""
     backoff = 2  # Start with 2 second backoff
     max_backoff = 64  # Cap at 64 seconds
 
@@ -116,13 +130,18 @@ def send_notification_with_backoff(title, message, max_retries=5):
             send_notification(title, message)
             return True
         except requests.HTTPError as e:
-            if e.response.status_code == 429:
+            status = e.response.status_code
+            if status in (429, 503):
                 if attempt < max_retries - 1:
-                    print(f"  Rate limit hit, retrying in {backoff}s...")
-                    time.sleep(backoff)
+                    # Prefer the server's own guidance over blind doubling, but
+                    # never stall the run longer than our own cap
+                    retry_after = e.response.headers.get("Retry-After", "")
+                    wait = min(int(retry_after), max_backoff) if retry_after.isdigit() else backoff
+                    print(f"  Got HTTP {status}, retrying in {wait}s...")
+                    time.sleep(wait + random.uniform(0, wait * 0.1))
                     backoff = min(backoff * 2, max_backoff)
                 else:
-                    print(f"  Rate limit hit, max retries reached")
+                    print(f"  Got HTTP {status}, max retries reached")
                     return False
             else:
                 print(f"  Failed to send notification: {e}")
@@ -136,19 +155,20 @@ def send_notification_with_backoff(title, message, max_retries=5):
 
 def check_and_notify():
     state = load_state()
-    seen_ids = set(state.get("seen_ids", []))
-    last_updated = state.get("rows_updated_at")
+    seen_ids = state["seen_ids"]
 
-    # Check if dataset has been updated
-    current_updated = get_rows_updated_at()
-    if current_updated == last_updated and seen_ids:
+    # The data query doubles as the freshness check: an unchanged result
+    # comes back as a 304 for the ETag we stored last run
+    calls, etag = fetch_recent_calls(state["calls_etag"])
+    if calls is None:
         print(f"[{datetime.now(timezone.utc).isoformat()}] No update detected, skipping.")
         return
 
-    print(f"[{datetime.now(timezone.utc).isoformat()}] Update detected, fetching calls...")
+    print(f"[{datetime.now(timezone.utc).isoformat()}] Update detected, checking calls...")
 
-    calls = fetch_recent_calls()
-    current_ids = {c.get("id") or c.get("cad_number") for c in calls}
+    # Oldest first, matching the order seen_ids is kept in
+    current_ids = dict.fromkeys(c.get("id") or c.get("cad_number") for c in reversed(calls))
+    current_ids.pop(None, None)
 
     # Find new calls
     if not seen_ids:
@@ -161,39 +181,54 @@ def check_and_notify():
     if new_calls:
         print(f"  Found {len(new_calls)} new HSOC calls.")
 
-        # Send individual notification for each HSOC call
+        # Batch calls so a burst costs one notification per chunk. Chunks go
+        # out one at a time, newest first, so the topic stays in order;
+        # NTFY_BUCKET paces them.
         sent_call_ids = []
-        for i, call in enumerate(new_calls):
-            call_type = call.get("call_type_original_desc") or "Unknown"
+        for start in range(0, len(new_calls), NOTIFICATION_BATCH_SIZE):
+            chunk = new_calls[start:start + NOTIFICATION_BATCH_SIZE]
+            if len(chunk) == 1:
+                call_type = chunk[0].get("call_type_original_desc") or "Unknown"
+                title = f"SF Dispatch - {call_type}"
+            else:
+                title = f"SF Dispatch - {len(chunk)} new calls"
             success = send_notification_with_backoff(
-                title=f"SF Dispatch - {call_type}",
-                message=format_call(call),
+                title=title,
+                message="\n\n---\n\n".join(format_call(c) for c in chunk),
             )
 
             if success:
-                # Track successfully sent call
-                call_id = call.get("id") or call.get("cad_number")
-                if call_id:
-                    sent_call_ids.append(call_id)
-                # Add delay between notifications to avoid rate limits
-                if i < len(new_calls) - 1:
-                    time.sleep(1)
+                # Track successfully sent calls
+                for call in chunk:
+                    call_id = call.get("id") or call.get("cad_number")
+                    if call_id:
+                        sent_call_ids.append(call_id)
             else:
-                # Rate limited after backoff - stop sending, will retry next run
-                print(f"  Stopped after {i + 1}/{len(new_calls)} notifications")
+                # Failed after backoff - stop sending, will retry next run.
+                # Drop the ETag so the next fetch isn't answered with a 304.
+                print(f"  Stopped after {start}/{len(new_calls)} calls notified")
+                etag = None
                 break
     else:
         sent_call_ids = []
         if seen_ids:
             print("  No new calls in this update.")
 
-    # Update state - only mark successfully sent calls as seen
-    updated_seen_ids = list(seen_ids) + sent_call_ids
-    state = {
+    # Update state - only mark successfully sent calls as seen. IDs are kept
+    # well past the fetch window, so a short or empty response can't make
+    # already-notified calls look new again; save_state caps the total.
+    if not seen_ids:
+        updated_seen_ids = current_ids
+    else:
+        updated_seen_ids = {**seen_ids, **dict.fromkeys(reversed(sent_call_ids))}
+    new_state = {
         "seen_ids": updated_seen_ids,
-        "rows_updated_at": current_updated,
+        "calls_etag": etag,
     }
-    save_state(state)
+    # Every non-304 response normally carries a fresh ETag, so this only
+    # skips the write when the server sent no ETag and nothing new was seen
+    if new_state != state:
+        save_state(new_state)
 
 
 def main():
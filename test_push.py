@@ -5,7 +5,8 @@ Send a test push notification to verify formatting
 
 import os
 import requests
-from datetime import datetime
+
+from formatting import format_call
 
 NTFY_TOPIC = os.environ.get("NTFY_TOPIC", "sf-dispatch-alerts-3190")
 NTFY_URL = f"https://ntfy.sh/{NTFY_TOPIC}"
@@ -22,46 +23,6 @@ test_call = {
     "onview_flag": "HSOC",
 }
 
-def format_call(call):
-    # Format datetime as "2/5/2026 8:51 PM"
-    received = call.get("received_datetime", "")
-    if received:
-        try:
-            dt = datetime.fromisoformat(received.replace("Z", "+00:00"))
-            received_formatted = dt.strftime("%-m/%-d/%Y %-I:%M %p")
-        except:
-            received_formatted = received
-    else:
-        received_formatted = "Unknown time"
-
-    call_type = call.get("call_type_original_desc") or "Unknown"
-    intersection = call.get("intersection_name") or "Unknown location"
-    neighborhood = call.get("analysis_neighborhood") or ""
-    agency = call.get("agency") or "Unknown agency"
-    sensitive = call.get("sensitive_call", False)
-    onview_flag = call.get("onview_flag", "Unknown")
-
-    if sensitive:
-        intersection = "[Sensitive - location suppressed]"
-
-    # Determine source
-    if onview_flag == "HSOC":
-        source = "HSOC Program"
-    else:
-        source = f"Call Type Filter ({onview_flag})"
-
-    lines = [
-        f"Time: {received_formatted}",
-        f"Type: {call_type}",
-        f"Location: {intersection}",
-    ]
-    if neighborhood and not sensitive:
-        lines.append(f"Neighborhood: {neighborhood}")
-    lines.append(f"Agency: {agency}")
-    lines.append(f"Source: {source}")
-
-    return "\n".join(lines)
-
 def send_notification(title, message):
     resp = requests.post(
         NTFY_URL,